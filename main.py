@@ -1,63 +1,436 @@
-from fastapi import FastAPI, Request
-from pydantic import BaseModel
-from playwright.async_api import async_playwright
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+import asyncio
+import logging
+import mmap
 import os
-import json
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import orjson
+
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
 COOKIE_FILE = "cookies.json"
+# 連続した更新をまとめてから書き込むまでの待ち時間(秒)
+FLUSH_DELAY = 0.2
+# 書き込みに失敗したときに再試行するまでの待ち時間(秒)
+FLUSH_RETRY_DELAY = 5.0
+# スクレイプ後、コンテキストのCookieをまとめて取り込むまでの待ち時間(秒)
+COOKIE_SYNC_INTERVAL = 5.0
+# プロセス全体で同時に開くページ数の上限
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", "8"))
+# /scrape/batch 1回あたりで同時に開くページ数の上限
+SCRAPE_BATCH_CONCURRENCY = int(os.getenv("SCRAPE_BATCH_CONCURRENCY", "4"))
+# /scrape/batch 1回で受け付けるURL数の上限
+SCRAPE_BATCH_MAX_URLS = int(os.getenv("SCRAPE_BATCH_MAX_URLS", "64"))
+# 描画結果をキャッシュする秒数と件数(HTML_CACHE_TTL=0 で無効化)
+HTML_CACHE_TTL = float(os.getenv("HTML_CACHE_TTL", "60"))
+HTML_CACHE_SIZE = int(os.getenv("HTML_CACHE_SIZE", "1024"))
+# HTMLの取得に不要なリソースは読み込まない(BLOCK_ASSETS=0 で無効化)
+# context.route を使うとPlaywrightの仕様でHTTPキャッシュが無効になる。
+# 有効にした場合、接続(DNS/TLS)はスクレイプ間で再利用されるがレスポンスのキャッシュは効かない
+BLOCK_ASSETS = os.getenv("BLOCK_ASSETS", "1") != "0"
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "media", "font", "stylesheet"})
+_SCHEMES = frozenset({"http", "https"})
+# 起動時に接続(DNS/TLS)を確立しておくURL。カンマ区切り
+WARMUP_URLS = [u for u in os.getenv("WARMUP_URLS", "").split(",") if u]
+# /scrape/quick: これより小さいHTMLやSPAの空コンテナはブラウザで描画し直す
+QUICK_MIN_HTML_SIZE = 2048
+_SPA_MARKERS = ('<div id="root"></div>', '<div id="app"></div>')
+# メモリ使用量と起動時間を抑えるためのChromium起動オプション
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-background-networking",
+    "--disable-features=IsolateOrigins,site-per-process",
+    "--disable-extensions",
+    "--disable-component-extensions-with-background-pages",
+    "--disable-sync",
+    "--mute-audio",
+    "--no-first-run",
+]
+if BLOCK_ASSETS:
+    # 画像はネットワークだけでなくレンダラでも読み込まない
+    CHROMIUM_ARGS.append("--blink-settings=imagesEnabled=false")
+CONTEXT_OPTIONS = {"viewport": {"width": 800, "height": 600}}
 
 class URLRequest(BaseModel):
     url: str
+    # Falseの場合はブラウザで描画せず、HTTPで取得したHTMLをそのまま返す
+    js: bool = True
+    # Trueの場合はキャッシュを使わずに描画し直す
+    force_refresh: bool = False
+
+class BatchURLRequest(BaseModel):
+    urls: List[str] = Field(max_length=SCRAPE_BATCH_MAX_URLS)
 
 class CookiesRequest(BaseModel):
     cookies: list
 
+# Cookieはメモリ上に保持し、ファイルは起動後最初のアクセス時のみ読む
+_cache: Optional[Dict[Tuple, Dict]] = None
+# エンコード済みのJSON。GET /cookies とファイル書き込みで使い回す
+_encoded: Optional[bytes] = None
+# 最後にファイルへ反映した内容。変化がなければ書き込まない
+_written: Optional[bytes] = None
+_cache_lock = threading.Lock()
+_write_lock = threading.Lock()
+_dirty = asyncio.Event()
+_context_dirty = asyncio.Event()
+_page_semaphore = asyncio.BoundedSemaphore(SCRAPE_CONCURRENCY)
+_inflight: Dict[str, asyncio.Task] = {}
+# URL -> (有効期限, HTML)。古いものから追い出す
+_html_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+# POST/DELETE /cookies のたびに増やし、古いセッションで描画した結果をキャッシュしない
+_session_generation = 0
+
+def _check_scheme(url):
+    # スキームは大文字小文字を区別しない(HTTPS://... も受け付ける)
+    if urlsplit(url).scheme.lower() not in _SCHEMES:
+        raise ValueError(f"unsupported URL scheme: {url}")
+
+def _cookie_key(cookie):
+    return (cookie.get("name"), cookie.get("domain"), cookie.get("path", "/"))
+
+def _read_cookie_file():
+    # ファイルはmmapして、読み込み用のコピーを作らずにデコードする
+    try:
+        with open(COOKIE_FILE, "rb") as f, mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+            with memoryview(mm) as view:
+                cookies = orjson.loads(view)
+    except (FileNotFoundError, ValueError):
+        return []
+    # キーに使う文字列はインターンしておく
+    for c in cookies:
+        for k in ("name", "domain"):
+            if isinstance(c.get(k), str):
+                c[k] = sys.intern(c[k])
+    return cookies
+
+def _write_cookie_file(data):
+    # 一時ファイルに書いてから置き換え、書き込み途中のファイルを残さない
+    tmp = COOKIE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        os.fsync(f.fileno())
+    os.replace(tmp, COOKIE_FILE)
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        _cache = {_cookie_key(c): c for c in _read_cookie_file()}
+    return _cache
+
 def load_cookies():
-    if os.path.exists(COOKIE_FILE):
-        with open(COOKIE_FILE, "r") as f:
-            return json.load(f)
-    return []
+    with _cache_lock:
+        return list(_get_cache().values())
+
+def load_cookies_bytes():
+    global _encoded
+    with _cache_lock:
+        if _encoded is None:
+            _encoded = orjson.dumps(list(_get_cache().values()))
+        return _encoded
 
 def save_cookies(cookies):
-    with open(COOKIE_FILE, "w") as f:
-        json.dump(cookies, f)
+    global _cache, _encoded
+    with _cache_lock:
+        _cache = {_cookie_key(c): c for c in cookies}
+        _encoded = None
+    _dirty.set()
 
-@app.post("/scrape")
-async def scrape(request: URLRequest):
-    async with async_playwright() as p:
-        browser = await p.firefox.launch(headless=True)
-        context = await browser.new_context()
-        # Cookieロード
-        cookies = load_cookies()
-        if cookies:
-            await context.add_cookies(cookies)
-        page = await context.new_page()
+def clear_cookies():
+    global _cache, _encoded
+    with _cache_lock:
+        _cache = {}
+        _encoded = None
+    _dirty.set()
+
+def _flush():
+    global _written
+    with _write_lock:
+        data = load_cookies_bytes()
+        if data == _written:
+            return
+        if data != b"[]":
+            _write_cookie_file(data)
+        elif os.path.exists(COOKIE_FILE):
+            os.remove(COOKIE_FILE)
+        # 書き込みに成功した場合のみ反映済みとして記録する
+        _written = data
+
+async def _flusher():
+    while True:
+        await _dirty.wait()
+        await asyncio.sleep(FLUSH_DELAY)
+        _dirty.clear()
         try:
-            await page.goto(request.url)
-            await page.wait_for_timeout(5000)
-            html = await page.content()
-            # Cookie取得・保存
-            cookies = await context.cookies()
-            save_cookies(cookies)
-            return {"html": html}
-        except Exception as e:
-            return {"error": str(e)}
+            await asyncio.to_thread(_flush)
+        except Exception:
+            # 失敗しても止めずに、時間をおいて再試行する
+            logger.exception("failed to write %s", COOKIE_FILE)
+            _dirty.set()
+            await asyncio.sleep(FLUSH_RETRY_DELAY)
+
+async def _pull_context_cookies(context):
+    cookies = await context.cookies()
+    # 前回から変化がなければ保存しない
+    if cookies != load_cookies():
+        save_cookies(cookies)
+
+async def _cookie_sync(context):
+    while True:
+        await _context_dirty.wait()
+        await asyncio.sleep(COOKIE_SYNC_INTERVAL)
+        _context_dirty.clear()
+        try:
+            await _pull_context_cookies(context)
+        except Exception:
+            # 失敗しても止めずに、次の間隔で再試行する
+            logger.exception("failed to sync cookies from the browser context")
+            _context_dirty.set()
+
+async def _warmup(context):
+    async def head(url):
+        response = await context.request.head(url, timeout=5000)
+        await response.dispose()
+
+    await asyncio.gather(*(head(u) for u in WARMUP_URLS), return_exceptions=True)
+
+async def _block_resources(route):
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+@asynccontextmanager
+async def lifespan(app):
+    # ブラウザとコンテキストは起動時に一度だけ作成し、リクエスト間で共有する
+    playwright = await async_playwright().start()
+    browser = await playwright.chromium.launch(headless=True, args=CHROMIUM_ARGS)
+    # Cookieロード(初回のファイル読み込みはイベントループの外で行う)
+    cookies = await asyncio.to_thread(load_cookies)
+    context = await browser.new_context(
+        **CONTEXT_OPTIONS,
+        storage_state={"cookies": cookies, "origins": []} if cookies else None,
+    )
+    if BLOCK_ASSETS:
+        await context.route("**/*", _block_resources)
+    app.state.context = context
+    app.state.idle_pages = []
+    tasks = [asyncio.create_task(_cookie_sync(context)), asyncio.create_task(_flusher())]
+    if WARMUP_URLS:
+        tasks.append(asyncio.create_task(_warmup(context)))
+    try:
+        yield
+    finally:
+        # Cookieの保存に失敗してもブラウザは必ず終了させる
+        try:
+            for task in tasks:
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+            # 変化がなければ保存されないので、常に最後の状態を取り込む
+            await _pull_context_cookies(context)
+            # 書き込み済みの内容と同じなら_flushは何もしない
+            await asyncio.to_thread(_flush)
         finally:
             await browser.close()
+            await playwright.stop()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+async def _get_html(url, force_refresh=False):
+    if not force_refresh:
+        hit = _html_cache.get(url)
+        if hit is not None and hit[0] > time.monotonic():
+            _html_cache.move_to_end(url)
+            return hit[1]
+    # 同じURLの取得が進行中なら、新しくページを開かずにその結果を共有する
+    # (force_refresh の場合はこのリクエストより前に始まった取得には相乗りしない)
+    task = None if force_refresh else _inflight.get(url)
+    if task is None:
+        task = asyncio.create_task(_render_and_cache(url))
+        _inflight[url] = task
+        task.add_done_callback(lambda t: _forget_inflight(url, t))
+    return await asyncio.shield(task)
+
+def _forget_inflight(url, task):
+    # 後から登録された別の取得は消さない
+    if _inflight.get(url) is task:
+        del _inflight[url]
+
+def _reset_session():
+    global _session_generation
+    _session_generation += 1
+    _html_cache.clear()
+    # 古いセッションで進行中の取得には相乗りさせない
+    _inflight.clear()
+
+async def _render_and_cache(url):
+    generation = _session_generation
+    html = await _render(url)
+    if HTML_CACHE_TTL > 0 and generation == _session_generation:
+        _html_cache[url] = (time.monotonic() + HTML_CACHE_TTL, html)
+        _html_cache.move_to_end(url)
+        while len(_html_cache) > HTML_CACHE_SIZE:
+            _html_cache.popitem(last=False)
+    return html
+
+async def _render(url):
+    # http(s)以外はページを開く前に弾く
+    _check_scheme(url)
+    async with _page_semaphore:
+        # ページは使い回す(数はセマフォの上限を超えない)
+        idle_pages = app.state.idle_pages
+        page = idle_pages.pop() if idle_pages else await app.state.context.new_page()
+        try:
+            # レスポンスヘッダの受信で戻り、待ち時間は下のnetworkidleの上限だけにする
+            await page.goto(url, wait_until="commit")
+            # 固定で待たず、ネットワークが落ち着いた時点で取得する(最大5秒)
+            try:
+                await page.wait_for_load_state("networkidle", timeout=5000)
+            except PlaywrightTimeoutError:
+                pass
+            html = await page.content()
+        except BaseException:
+            # 状態が分からないページは戻さずに閉じる
+            await page.close()
+            raise
+        # Cookieはバックグラウンドでまとめて取得・保存する
+        _context_dirty.set()
+        try:
+            await page.goto("about:blank")
+        except Exception:
+            await page.close()
+        else:
+            idle_pages.append(page)
+        return html
+
+@app.post("/scrape")
+async def scrape(request: URLRequest):
+    try:
+        if not request.js:
+            return {"html": await _fetch_html(request.url)}
+        return {"html": await _get_html(request.url, request.force_refresh)}
+    except Exception as e:
+        return {"error": str(e)}
+
+async def _fetch(url):
+    # ブラウザで描画せずに取得する。context.request はコンテキストとCookieを共有する
+    _check_scheme(url)
+    response = await app.state.context.request.get(url, timeout=5000)
+    _context_dirty.set()
+    return response
+
+def _response_charset(response):
+    # content-type のcharsetを使う。指定がなければUTF-8とみなす
+    for param in response.headers.get("content-type", "").split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset" and value.strip("\"' "):
+            return value.strip("\"' ")
+    return "utf-8"
+
+async def _fetch_html(url):
+    response = await _fetch(url)
+    try:
+        body = await response.body()
+    finally:
+        await response.dispose()
+    # 描画に任せられないので、デコードできない文字は置き換えて返す
+    try:
+        return body.decode(_response_charset(response), errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+async def _fetch_static(url):
+    # 描画が必要そうならNoneを返す
+    try:
+        response = await _fetch(url)
+    except Exception:
+        return None
+    try:
+        if not response.ok or not response.headers.get("content-type", "").startswith("text/html"):
+            return None
+        # UTF-8以外のページもcharsetに従ってデコードし、失敗したらブラウザに任せる
+        try:
+            html = (await response.body()).decode(_response_charset(response))
+        except (UnicodeDecodeError, LookupError):
+            return None
+    finally:
+        await response.dispose()
+    if len(html) < QUICK_MIN_HTML_SIZE or any(m in html for m in _SPA_MARKERS):
+        return None
+    return html
+
+@app.post("/scrape/quick")
+async def quick_scrape(request: URLRequest):
+    try:
+        html = await _fetch_static(request.url)
+        if html is None:
+            html = await _get_html(request.url, request.force_refresh)
+        return {"html": html}
+    except Exception as e:
+        return {"error": str(e)}
+
+@app.post("/scrape/batch")
+async def scrape_batch(request: BatchURLRequest):
+    # 共有コンテキスト上でURLごとにページを開き、同時実行数はセマフォで制限する
+    sem = asyncio.BoundedSemaphore(SCRAPE_BATCH_CONCURRENCY)
+
+    async def run(url):
+        async with sem:
+            return await _get_html(url)
+
+    # 重複したURLは一度だけ取得し、結果を元の順序に割り当てる
+    unique = list(dict.fromkeys(request.urls))
+    results = await asyncio.gather(*(run(u) for u in unique), return_exceptions=True)
+    by_url = dict(zip(unique, results))
+    response_data = []
+    for url in request.urls:
+        result = by_url[url]
+        if isinstance(result, Exception):
+            response_data.append({"url": url, "error": str(result)})
+        else:
+            response_data.append({"url": url, "html": result})
+    return {"results": response_data}
 
 @app.get("/cookies")
 async def get_cookies():
-    cookies = load_cookies()
-    return {"cookies": cookies}
+    # デコードと再エンコードを省き、エンコード済みのJSONをそのまま返す
+    content = b'{"cookies":' + load_cookies_bytes() + b"}"
+    return Response(content=content, media_type="application/json")
 
 @app.post("/cookies")
 async def set_cookies(req: CookiesRequest):
-    save_cookies(req.cookies)
+    context = app.state.context
+    # 不正なCookieで失敗した場合は元のCookieに戻し、保存もしない
+    previous = await context.cookies()
+    await context.clear_cookies()
+    try:
+        if req.cookies:
+            await context.add_cookies(req.cookies)
+    except Exception as e:
+        await context.clear_cookies()
+        if previous:
+            await context.add_cookies(previous)
+        return {"error": str(e)}
+    # url指定のCookieもdomain/path付きの形で保存するため、コンテキストから取り直す
+    save_cookies(await context.cookies())
+    _reset_session()
     return {"status": "saved"}
 
 @app.delete("/cookies")
 async def delete_cookies():
-    if os.path.exists(COOKIE_FILE):
-        os.remove(COOKIE_FILE)
+    await app.state.context.clear_cookies()
+    clear_cookies()
+    _reset_session()
     return {"status": "deleted"}